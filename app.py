@@ -1,12 +1,46 @@
+import asyncio
+import hashlib
+import itertools
 import os
 import json
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Any, Dict, List, Optional
 
 import sqlite3
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from langchain_openai import ChatOpenAI
 import httpx
+import sqlglot
+from sqlglot import exp
+
+# Semantic cache dependencies are optional; without them we silently fall
+# back to exact-match caching only.
+try:
+    import faiss
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+
+    SEMANTIC_CACHE_AVAILABLE = True
+except ImportError:
+    SEMANTIC_CACHE_AVAILABLE = False
+
+# Filesystem watcher is optional too; without it the schema cache is simply
+# rebuilt lazily on the first request after a change.
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    WATCHDOG_AVAILABLE = False
 
 
 class NLQueryRequest(BaseModel):
@@ -29,49 +63,429 @@ GENAI_MODEL = "azure_ai/genailab-maas-DeepSeek-V3-0324"
 
 GENAI_API_KEY = os.getenv(GENAI_API_KEY_ENV, "sk-PHXT5d_JGKnDksrzSEI0Xg")
 
-http_client = httpx.Client(verify=False)
+# HTTP/2 with a generous keep-alive pool: concurrent LLM calls multiplex
+# over one warm connection instead of paying a TCP+TLS handshake each
+HTTP_LIMITS = httpx.Limits(
+    max_keepalive_connections=50,
+    max_connections=100,
+    keepalive_expiry=60.0,
+)
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+
+http_client = httpx.Client(
+    verify=False,
+    http2=True,
+    limits=HTTP_LIMITS,
+    timeout=HTTP_TIMEOUT,
+)
+
+# langchain-openai only uses http_client for sync calls; ainvoke goes
+# through a separately configured async client, which must also skip TLS
+# verification against the gateway
+http_async_client = httpx.AsyncClient(
+    verify=False,
+    http2=True,
+    limits=HTTP_LIMITS,
+    timeout=HTTP_TIMEOUT,
+)
 
 llm = ChatOpenAI(
     base_url=GENAI_BASE_URL,
     model=GENAI_MODEL,
     api_key=GENAI_API_KEY,
     http_client=http_client,
+    http_async_client=http_async_client,
 )
 
 
 app = FastAPI(title="NL-to-SQL SQLite API", version="1.0.0")
 
+# Static instruction block placed FIRST in the prompt. Providers cache the
+# KV state of a byte-identical prompt prefix, so the invariant instructions
+# and the (per-DB stable) schema must precede the user question.
+INSTRUCTIONS_STATIC = (
+    "Return a single SQLite query that correctly answers the question. "
+    "Use proper JOINs when needed. Do not modify data. Read-only queries only. "
+    "Treat all text comparisons as case-insensitive by default (for example using COLLATE NOCASE "
+    "or LOWER() on both sides of the comparison). For instance, if the question says severity 'high' "
+    "and the data stores 'High', still return those rows by using a case-insensitive comparison."
+)
+
+# In-process LRU cache for generated SQL keyed by a hash of the prompt.
+# Repeated questions against the same schema skip the LLM round-trip entirely.
+SQL_CACHE_MAX_ENTRIES = 1024
+SQL_CACHE_TTL_SECONDS = 300.0
+
+# prompt_hash -> (timestamp, sql), oldest entries first
+_SQL_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+
+
+def _prompt_cache_key(prompt: str, max_tokens: int) -> str:
+    digest = hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+    return f"{max_tokens}:{digest}"
+
+
+def _sql_cache_get(key: str) -> Optional[str]:
+    entry = _SQL_CACHE.get(key)
+    if entry is None:
+        return None
+    timestamp, sql = entry
+    if time.monotonic() - timestamp > SQL_CACHE_TTL_SECONDS:
+        del _SQL_CACHE[key]
+        return None
+    _SQL_CACHE.move_to_end(key)
+    return sql
+
+
+def _sql_cache_put(key: str, sql: str) -> None:
+    _SQL_CACHE[key] = (time.monotonic(), sql)
+    _SQL_CACHE.move_to_end(key)
+    while len(_SQL_CACHE) > SQL_CACHE_MAX_ENTRIES:
+        _SQL_CACHE.popitem(last=False)
+
+
+# Persistent answer cache in SQLite: survives restarts and is shared by
+# every Uvicorn worker, unlike the per-process dict above.
+ANSWER_CACHE_DB = "cache.db"
+ANSWER_CACHE_TTL_SECONDS = 24 * 3600
+
+_answer_cache_conn: Optional[sqlite3.Connection] = None
+_answer_cache_lock = threading.Lock()
+
+
+def _answer_cache() -> sqlite3.Connection:
+    global _answer_cache_conn
+    if _answer_cache_conn is None:
+        conn = sqlite3.connect(ANSWER_CACHE_DB, check_same_thread=False)
+        conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "CREATE TABLE IF NOT EXISTS answer_cache ("
+            "  prompt_hash TEXT PRIMARY KEY,"
+            "  sql TEXT NOT NULL,"
+            "  created_at INTEGER NOT NULL,"
+            "  hits INTEGER NOT NULL DEFAULT 0"
+            ");"
+        )
+        _answer_cache_conn = conn
+    return _answer_cache_conn
+
+
+def _answer_cache_get(prompt_hash: str) -> Optional[str]:
+    cutoff = int(time.time()) - ANSWER_CACHE_TTL_SECONDS
+    with _answer_cache_lock:
+        conn = _answer_cache()
+        row = conn.execute(
+            "SELECT sql FROM answer_cache WHERE prompt_hash=? AND created_at > ?",
+            (prompt_hash, cutoff),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE answer_cache SET hits = hits + 1 WHERE prompt_hash=?",
+            (prompt_hash,),
+        )
+        conn.commit()
+        return row[0]
 
-def get_db_schema(db_path: str) -> str:
-    if not os.path.exists(db_path):
-        raise HTTPException(status_code=400, detail=f"Database file not found: {db_path}")
 
+def _answer_cache_put(prompt_hash: str, sql: str) -> None:
+    with _answer_cache_lock:
+        conn = _answer_cache()
+        conn.execute(
+            "INSERT OR REPLACE INTO answer_cache (prompt_hash, sql, created_at, hits) "
+            "VALUES (?, ?, ?, 0)",
+            (prompt_hash, sql, int(time.time())),
+        )
+        conn.commit()
+
+
+# Semantic cache: embeds each question and reuses cached SQL when a new
+# question is a near-duplicate (cosine similarity above the threshold) of
+# one already answered against the same database.
+SEMANTIC_MODEL_NAME = "all-MiniLM-L6-v2"
+SEMANTIC_EMBEDDING_DIM = 384
+SEMANTIC_SIMILARITY_THRESHOLD = 0.92
+SEMANTIC_INDEX_PATH = "semantic_cache.index"
+SEMANTIC_ENTRIES_PATH = "semantic_cache.json"
+
+_semantic_model = None
+_semantic_index = None
+# Parallel to the index rows: {"db_path": ..., "sql": ...}
+_semantic_entries: List[Dict[str, str]] = []
+# FAISS index ops are not thread-safe, and lookups run concurrently with
+# adds in threadpool threads
+_semantic_lock = threading.Lock()
+
+
+def _get_semantic_model():
+    global _semantic_model
+    if _semantic_model is None:
+        _semantic_model = SentenceTransformer(SEMANTIC_MODEL_NAME)
+    return _semantic_model
+
+
+def _get_semantic_index():
+    global _semantic_index
+    if _semantic_index is None:
+        _semantic_index = faiss.IndexFlatIP(SEMANTIC_EMBEDDING_DIM)
+    return _semantic_index
+
+
+def _embed_question(question: str) -> "np.ndarray":
+    # Normalized embeddings make inner product equal to cosine similarity
+    vec = _get_semantic_model().encode([question], normalize_embeddings=True)
+    return np.asarray(vec, dtype="float32")
+
+
+def _semantic_cache_lookup(question: str, db_path: str) -> Optional[str]:
+    if not SEMANTIC_CACHE_AVAILABLE or not _semantic_entries:
+        return None
+    vec = _embed_question(question)
+    with _semantic_lock:
+        scores, ids = _get_semantic_index().search(vec, 1)
+        if ids[0][0] < 0 or scores[0][0] < SEMANTIC_SIMILARITY_THRESHOLD:
+            return None
+        entry = _semantic_entries[ids[0][0]]
+    if entry["db_path"] != db_path:
+        return None
+    return entry["sql"]
+
+
+def _semantic_cache_add(question: str, db_path: str, sql: str) -> None:
+    if not SEMANTIC_CACHE_AVAILABLE:
+        return
+    vec = _embed_question(question)
+    with _semantic_lock:
+        # Append before add so any index id that becomes searchable is
+        # always resolvable in the entry list
+        _semantic_entries.append({"db_path": db_path, "sql": sql})
+        _get_semantic_index().add(vec)
+
+
+def _semantic_cache_load() -> None:
+    if not SEMANTIC_CACHE_AVAILABLE:
+        return
+    global _semantic_index
+    if os.path.exists(SEMANTIC_INDEX_PATH) and os.path.exists(SEMANTIC_ENTRIES_PATH):
+        _semantic_index = faiss.read_index(SEMANTIC_INDEX_PATH)
+        with open(SEMANTIC_ENTRIES_PATH) as f:
+            _semantic_entries.extend(json.load(f))
+
+
+def _semantic_cache_save() -> None:
+    if not SEMANTIC_CACHE_AVAILABLE or not _semantic_entries:
+        return
+    with _semantic_lock:
+        faiss.write_index(_get_semantic_index(), SEMANTIC_INDEX_PATH)
+        with open(SEMANTIC_ENTRIES_PATH, "w") as f:
+            json.dump(_semantic_entries, f)
+
+
+@app.on_event("startup")
+async def _load_semantic_cache() -> None:
+    _semantic_cache_load()
+
+
+@app.on_event("shutdown")
+async def _persist_semantic_cache() -> None:
+    _semantic_cache_save()
+    if _observer is not None:
+        _observer.stop()
+
+
+# Pool of long-lived SQLite connections per db_path, so requests reuse a
+# hot page cache instead of paying connect/close and mmap setup each time.
+# Each pool is stamped with the file identity (st_dev, st_ino) it was
+# opened against: if the file is replaced (rm + reseed, atomic-rename
+# deploy), pooled handles would otherwise keep serving the old inode.
+_POOLS: Dict[str, tuple] = {}  # db_path -> ((st_dev, st_ino), LifoQueue)
+_POOLS_LOCK = threading.Lock()
+
+# Databases we have already run ANALYZE against in this process. Keyed by
+# db_path only: ANALYZE rewrites the stat tables (and thus the file mtime),
+# so an mtime-based key would keep re-triggering itself.
+_ANALYZED: set = set()
+
+
+def _new_connection(db_path: str) -> sqlite3.Connection:
+    if db_path not in _ANALYZED:
+        _ANALYZED.add(db_path)
+        # ANALYZE needs write access, so run it on a short-lived regular
+        # connection; the pooled connections below are read-only.
+        # Best-effort: a DB we cannot write to still serves reads fine.
+        try:
+            writer = sqlite3.connect(db_path)
+            writer.executescript("ANALYZE; PRAGMA optimize;")
+            writer.close()
+        except sqlite3.Error:
+            pass
+
+    # Read-only with mmap: readers serve pages straight from the mapped
+    # file and never contend on the writer lock
     try:
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to connect to database: {exc}")
+    conn.row_factory = sqlite3.Row
+    conn.executescript(
+        "PRAGMA query_only=1;"
+        "PRAGMA mmap_size=268435456;"
+        "PRAGMA cache_size=-65536;"
+        "PRAGMA temp_store=MEMORY;"
+    )
+    return conn
 
+
+@contextmanager
+def borrow(db_path: str):
+    """Borrow a pooled connection for db_path, creating one if the pool is empty."""
+    try:
+        st = os.stat(db_path)
+    except OSError:
+        raise HTTPException(status_code=400, detail=f"Database file not found: {db_path}")
+    file_id = (st.st_dev, st.st_ino)
+
+    with _POOLS_LOCK:
+        entry = _POOLS.get(db_path)
+        if entry is None or entry[0] != file_id:
+            if entry is not None:
+                # File was replaced: close idle handles still bound to the
+                # old inode; borrowed ones are dropped when returned to the
+                # orphaned queue and garbage collected
+                _drain_pool(entry[1])
+                _ANALYZED.discard(db_path)
+            entry = (file_id, queue.LifoQueue())
+            _POOLS[db_path] = entry
+        pool = entry[1]
+
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = _new_connection(db_path)
     try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+
+def _drain_pool(pool: "queue.LifoQueue[sqlite3.Connection]") -> None:
+    while True:
+        try:
+            pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+# Schema cache keyed by (db_path, mtime_ns) so warm requests skip all
+# SQLite introspection; any write to the DB file changes the key.
+SCHEMA_CACHE_MAX_ENTRIES = 256
+
+# Accessed from threadpool threads and the watchdog observer thread
+_SCHEMA_CACHE: "OrderedDict[tuple, str]" = OrderedDict()
+_SCHEMA_CACHE_LOCK = threading.Lock()
+
+# Watcher that rebuilds the schema cache in the background when a watched
+# DB file changes, so the first request after a change still hits a warm
+# cache. Maps abspath -> db_path as requests refer to it, so the rebuild
+# uses the same cache key.
+_WATCHED_DB_PATHS: Dict[str, str] = {}
+_WATCHED_DIRS: set = set()
+_observer = None
+_observer_lock = threading.Lock()
+
+if WATCHDOG_AVAILABLE:
+
+    class _SchemaRefreshHandler(FileSystemEventHandler):
+        def on_modified(self, event):
+            db_path = _WATCHED_DB_PATHS.get(os.path.abspath(getattr(event, "src_path", "")))
+            if db_path is None:
+                return
+            try:
+                # Repopulates _SCHEMA_CACHE under the new mtime key
+                get_db_schema(db_path)
+            except HTTPException:
+                # Mid-write or vanished file; the next request falls back
+                # to a synchronous build
+                pass
+
+
+def _watch_db_path(db_path: str) -> None:
+    if not WATCHDOG_AVAILABLE:
+        return
+    global _observer
+    abspath = os.path.abspath(db_path)
+    with _observer_lock:
+        if abspath in _WATCHED_DB_PATHS:
+            return
+        _WATCHED_DB_PATHS[abspath] = db_path
+        if _observer is None:
+            _observer = Observer()
+            _observer.start()
+        directory = os.path.dirname(abspath) or "."
+        if directory not in _WATCHED_DIRS:
+            _WATCHED_DIRS.add(directory)
+            _observer.schedule(_SchemaRefreshHandler(), directory)
+
+
+def get_db_schema(db_path: str) -> str:
+    if not os.path.exists(db_path):
+        raise HTTPException(status_code=400, detail=f"Database file not found: {db_path}")
+
+    _watch_db_path(db_path)
+
+    cache_key = (db_path, os.stat(db_path).st_mtime_ns)
+    with _SCHEMA_CACHE_LOCK:
+        cached = _SCHEMA_CACHE.get(cache_key)
+        if cached is not None:
+            _SCHEMA_CACHE.move_to_end(cache_key)
+            return cached
+
+    with borrow(db_path) as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
-        tables = [row[0] for row in cursor.fetchall()]
+        # One round-trip for all tables instead of one PRAGMA per table
+        cursor.execute(
+            "SELECT m.name, p.name, p.type, p.pk "
+            "FROM sqlite_master m JOIN pragma_table_info(m.name) p "
+            "WHERE m.type='table' AND m.name NOT LIKE 'sqlite_%' "
+            "ORDER BY m.name, p.cid"
+        )
+        all_columns = cursor.fetchall()
 
         schema_descriptions = []
-        for table in tables:
-            cursor.execute(f"PRAGMA table_info('{table}')")
-            cols = cursor.fetchall()
+        for table, cols in itertools.groupby(all_columns, key=lambda r: r[0]):
             col_desc = ", ".join(
-                f"{c[1]} {c[2]}{' PRIMARY KEY' if c[5] == 1 else ''}"
+                f"{c[1]} {c[2]}{' PRIMARY KEY' if c[3] == 1 else ''}"
                 for c in cols
             )
             schema_descriptions.append(f"TABLE {table}: {col_desc}")
 
-        return "\n".join(schema_descriptions)
-    finally:
-        conn.close()
+        schema = "\n".join(schema_descriptions)
+        with _SCHEMA_CACHE_LOCK:
+            _SCHEMA_CACHE[cache_key] = schema
+            _SCHEMA_CACHE.move_to_end(cache_key)
+            while len(_SCHEMA_CACHE) > SCHEMA_CACHE_MAX_ENTRIES:
+                _SCHEMA_CACHE.popitem(last=False)
+        return schema
+
+
+# Fence-first extraction: a fenced code block always wins over the keyword
+# scan, since prose before the fence ("a query with a JOIN") can contain
+# SQL keywords. The keyword pattern captures from a leading keyword through
+# a semicolon (or end of text).
+_FENCE_RE = re.compile(r"```(?:sql)?\s*(.*?)\s*```", re.IGNORECASE | re.DOTALL)
+_SQL_KEYWORD_RE = re.compile(
+    r"\b((?:select|with|insert|update|delete)\b.*?(?:;|$))",
+    re.IGNORECASE | re.DOTALL,
+)
 
 
-def call_openai_for_sql(prompt: str, max_tokens: int) -> str:
+# Single-flight: identical prompts already being answered share one task
+# instead of each firing their own LLM call
+_INFLIGHT: Dict[str, "asyncio.Task[str]"] = {}
+
+
+async def call_openai_for_sql(prompt: str, max_tokens: int) -> str:
     if not GENAI_API_KEY:
         raise HTTPException(
             status_code=500,
@@ -81,9 +495,48 @@ def call_openai_for_sql(prompt: str, max_tokens: int) -> str:
             ),
         )
 
+    cache_key = _prompt_cache_key(prompt, max_tokens)
+    cached = _sql_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Persistent cache: another worker (or a previous process) may have
+    # already answered this prompt
+    cached = await run_in_threadpool(_answer_cache_get, cache_key)
+    if cached is not None:
+        _sql_cache_put(cache_key, cached)
+        return cached
+
+    task = _INFLIGHT.get(cache_key)
+    if task is None:
+        # The LLM call runs as an independent task so it (and any coalesced
+        # followers) survives cancellation of the request that started it
+        task = asyncio.create_task(_generate_and_cache_sql(cache_key, prompt))
+        _INFLIGHT[cache_key] = task
+        task.add_done_callback(lambda t, key=cache_key: _on_inflight_done(key, t))
+    # shield keeps this requester's cancellation from propagating to the task
+    return await asyncio.shield(task)
+
+
+def _on_inflight_done(cache_key: str, task: "asyncio.Task[str]") -> None:
+    _INFLIGHT.pop(cache_key, None)
+    if not task.cancelled():
+        # Mark retrieved so lone failures don't log "exception never retrieved"
+        task.exception()
+
+
+async def _generate_and_cache_sql(cache_key: str, prompt: str) -> str:
+    sql = await _invoke_llm_for_sql(prompt)
+    _sql_cache_put(cache_key, sql)
+    await run_in_threadpool(_answer_cache_put, cache_key, sql)
+    return sql
+
+
+async def _invoke_llm_for_sql(prompt: str) -> str:
     try:
-        # LangChain ChatOpenAI-style call, same as in llmTest.py
-        result = llm.invoke(prompt)
+        # LangChain's async entrypoint keeps the event loop free while the
+        # LLM call is in flight
+        result = await llm.ainvoke(prompt)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"LLM API error: {exc}")
 
@@ -97,103 +550,123 @@ def call_openai_for_sql(prompt: str, max_tokens: int) -> str:
 
     text = (content or "").strip()
 
-    # 1) If there's a fenced code block, try to extract SQL from the FIRST fenced block
-    if "```" in text:
-        parts = text.split("```")
-        # parts: [before, maybe 'sql\n...code...', after, ...]
-        if len(parts) >= 2:
-            first_block = parts[1]
-            block_stripped = first_block.strip()
-            if block_stripped.lower().startswith("sql"):
-                # remove leading 'sql' label line
-                block_stripped = block_stripped[3:].lstrip("\n")
-            text = block_stripped.strip()
-
-    # 2) Strip leading/trailing backticks/newlines again in case of residual fences
-    if text.startswith("```"):
-        text = text.strip("`\n ")
-        if text.lower().startswith("sql"):
-            text = text[3:].lstrip("\n")
-
-    # 3) If there is still explanation text, try to slice from first SQL keyword
-    lowered = text.lower()
-    start_idx = -1
-    for kw in ["select", "with", "insert", "update", "delete"]:
-        idx = lowered.find(kw)
-        if idx != -1 and (start_idx == -1 or idx < start_idx):
-            start_idx = idx
-
-    if start_idx != -1:
-        text = text[start_idx:]
-    else:
-        # No apparent SQL keywords; better to fail fast than send explanation text to SQLite
+    fence = _FENCE_RE.search(text)
+    # The fenced block may still wrap the statement in prose, so the
+    # keyword scan runs on the fence contents (or the whole text if the
+    # response isn't fenced)
+    match = _SQL_KEYWORD_RE.search(fence.group(1) if fence is not None else text)
+    sql = match.group(1).strip() if match is not None else ""
+
+    if not sql:
+        # No apparent SQL; better to fail fast than send explanation text to SQLite
         raise HTTPException(
             status_code=500,
             detail="Could not extract a valid SQL query from LLM response.",
         )
 
-    # 4) Trim after the last semicolon if present
-    semi_idx = text.rfind(";")
-    if semi_idx != -1:
-        text = text[: semi_idx + 1]
+    return _ensure_read_only(sql)
 
-    return text.strip()
 
+# sqlglot embeds ANSI escape codes in its error messages; keep them out
+# of JSON error bodies
+_ANSI_RE = re.compile(r"\x1b\[[0-9;]*m")
 
-def execute_sql(db_path: str, sql: str) -> (List[Dict[str, Any]], List[str]):
-    try:
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Failed to connect to database: {exc}")
 
+def _ensure_read_only(sql: str) -> str:
+    """Parse the SQL and reject anything that is not a read-only query."""
     try:
-        cursor = conn.cursor()
-        cursor.execute(sql)
-        rows_raw = cursor.fetchall()
-        columns = [d[0] for d in cursor.description] if cursor.description else []
-        rows = [dict(row) for row in rows_raw]
-        return rows, columns
-    except sqlite3.Error as exc:
-        raise HTTPException(status_code=400, detail=f"SQL execution error: {exc}; SQL={sql}")
-    finally:
-        conn.close()
+        tree = sqlglot.parse_one(sql, read="sqlite")
+    except sqlglot.errors.SqlglotError as exc:
+        # SqlglotError covers tokenizer failures (TokenError) as well as
+        # ParseError
+        raise HTTPException(
+            status_code=500,
+            detail=f"Could not parse SQL from LLM response: {_ANSI_RE.sub('', str(exc))}",
+        )
+
+    if not isinstance(tree, (exp.Select, exp.Union)):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Only read-only SELECT queries are allowed; got: {sql}",
+        )
+
+    # Round-trip through the AST to get a normalized statement
+    return tree.sql(dialect="sqlite")
+
+
+# Hard cap on rows pulled into Python per query, so a runaway
+# "SELECT * FROM big_table" cannot exhaust memory
+MAX_RESULT_ROWS = 1000
 
 
-@app.post("/nl-query", response_model=NLQueryResponse)
-async def nl_query(payload: NLQueryRequest) -> NLQueryResponse:
-    schema = get_db_schema(payload.db_path)
+def execute_sql(db_path: str, sql: str) -> (List[sqlite3.Row], List[str]):
+    # Rows are returned as sqlite3.Row (tuple-like, no dict per row);
+    # callers convert to dicts only where the wire format needs them
+    with borrow(db_path) as conn:
+        try:
+            cursor = conn.cursor()
+            cursor.arraysize = MAX_RESULT_ROWS
+            cursor.execute(sql)
+            # fetchmany stops stepping the statement after the cap,
+            # regardless of whether the LLM emitted a LIMIT
+            rows_raw = cursor.fetchmany(MAX_RESULT_ROWS)
+            columns = [d[0] for d in cursor.description] if cursor.description else []
+            return rows_raw, columns
+        except sqlite3.Error as exc:
+            raise HTTPException(status_code=400, detail=f"SQL execution error: {exc}; SQL={sql}")
 
+
+@app.post("/nl-query", response_class=ORJSONResponse)
+async def nl_query(payload: NLQueryRequest) -> ORJSONResponse:
+    # sqlite3 and the embedding model are blocking; keep them off the event loop
+    schema = await run_in_threadpool(get_db_schema, payload.db_path)
+
+    cached_sql = await run_in_threadpool(
+        _semantic_cache_lookup, payload.question, payload.db_path
+    )
+
+    # Static-first ordering keeps the prefix byte-identical across requests
+    # to the same DB, so the provider's prompt cache can hit on it
     prompt = (
+        f"{INSTRUCTIONS_STATIC}\n\n"
         f"SQLite schema:\n{schema}\n\n"
-        f"User question: {payload.question}\n\n"
-        "Return a single SQLite query that correctly answers the question. "
-        "Use proper JOINs when needed. Do not modify data. Read-only queries only. "
-        "Treat all text comparisons as case-insensitive by default (for example using COLLATE NOCASE "
-        "or LOWER() on both sides of the comparison). For instance, if the question says severity 'high' "
-        "and the data stores 'High', still return those rows by using a case-insensitive comparison."
+        f"User question: {payload.question}"
     )
 
-    sql = call_openai_for_sql(prompt, payload.max_tokens)
-    rows, columns = execute_sql(payload.db_path, sql)
+    if cached_sql is not None:
+        sql = cached_sql
+    else:
+        sql = await call_openai_for_sql(prompt, payload.max_tokens)
+        await run_in_threadpool(_semantic_cache_add, payload.question, payload.db_path, sql)
+
+    rows_raw, columns = await run_in_threadpool(execute_sql, payload.db_path, sql)
 
     # Build a Markdown table summary from the result rows
     summary: Optional[str] = None
     if columns:
         # Limit number of rows shown in the table to keep it compact
         max_rows = 20
-        display_rows = rows[:max_rows]
+        display_rows = rows_raw[:max_rows]
 
         header = "| " + " | ".join(str(c) for c in columns) + " |"
         separator = "| " + " | ".join(["---"] * len(columns)) + " |"
         body_lines = []
         for r in display_rows:
-            body_lines.append("| " + " | ".join(str(r.get(c, "")) for c in columns) + " |")
+            # Indexed access on sqlite3.Row avoids building a dict per row
+            body_lines.append("| " + " | ".join(str(r[i]) for i in range(len(columns))) + " |")
 
         table_lines = [header, separator] + body_lines
         summary = "\n".join(table_lines)
 
-    return NLQueryResponse(sql=sql, rows=rows, columns=columns, summary=summary)
+    # Dicts are only materialized here, where the JSON response needs them
+    rows = [dict(row) for row in rows_raw]
+
+    # Returning a Response directly skips the jsonable_encoder walk over
+    # every row; orjson serializes the payload in C (see NLQueryResponse
+    # for the shape)
+    return ORJSONResponse(
+        {"sql": sql, "rows": rows, "columns": columns, "raw_answer": None, "summary": summary}
+    )
 
 
 @app.get("/health")
@@ -1,6 +1,7 @@
 import sqlite3
 
 conn = sqlite3.connect("sample.db")
+conn.executescript("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;")
 cur = conn.cursor()
 
 cur.execute("""
@@ -21,8 +22,24 @@ CREATE TABLE IF NOT EXISTS orders (
 );
 """)
 
+# Indexes for the access patterns the NL endpoint generates: JOINs from
+# customers to orders, and case-insensitive city filters
+cur.execute("""
+CREATE INDEX IF NOT EXISTS idx_orders_customer_date
+ON orders(customer_id, order_date DESC);
+""")
+
+cur.execute("""
+CREATE INDEX IF NOT EXISTS idx_customers_city
+ON customers(city COLLATE NOCASE);
+""")
+
+# Single explicit transaction so all inserts share one commit/fsync;
+# OR IGNORE keeps re-runs idempotent instead of failing on the PKs
+cur.execute("BEGIN IMMEDIATE")
+
 cur.executemany(
-    "INSERT INTO customers (id, name, city) VALUES (?, ?, ?)",
+    "INSERT OR IGNORE INTO customers (id, name, city) VALUES (?, ?, ?)",
     [
         (1, "Alice", "London"),
         (2, "Bob", "Paris"),
@@ -31,7 +48,7 @@ cur.executemany(
 )
 
 cur.executemany(
-    "INSERT INTO orders (id, customer_id, amount, order_date) VALUES (?, ?, ?, ?)",
+    "INSERT OR IGNORE INTO orders (id, customer_id, amount, order_date) VALUES (?, ?, ?, ?)",
     [
         (1, 1, 120.50, "2024-10-01"),
         (2, 1, 80.00, "2024-10-05"),